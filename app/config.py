@@ -1,32 +1,43 @@
 import logging
+from functools import lru_cache
 from pathlib import Path
-from typing import List
+from typing import Tuple
 
 import yaml
-from pydantic import BaseModel, StrictInt, StrictStr, root_validator, validator
+from pydantic import BaseModel, ConfigDict
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s -  %(name)s - %(levelname)s - %(message)s")
 logger = logging.getLogger("config")
 
+# use the libyaml C parser when available
+SafeLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
 
 class MeterConfig(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
     id: int
     name: str
     offset: float = 0
 
 
 class RoomConfig(BaseModel):
-    name: StrictStr
-    meters: List[MeterConfig]
+    model_config = ConfigDict(frozen=True)
+
+    name: str
+    meters: Tuple[MeterConfig, ...]
 
 
 class RoomsConfig(BaseModel):
-    rooms: List[RoomConfig]
+    model_config = ConfigDict(frozen=True)
+
+    rooms: Tuple[RoomConfig, ...]
 
 
 def get_config(configfile: Path) -> RoomsConfig:
     """
     Parse the config file into a Pydantic model.
+    The parsed config is cached until the file is modified and shared between all callers, hence the models are frozen.
 
     Parameters
     ----------
@@ -41,6 +52,15 @@ def get_config(configfile: Path) -> RoomsConfig:
 
     if configfile.suffix not in [".yaml", ".yml"]:
         raise ValueError("Config file must be YAML with suffix .yaml or .yml")
+    return _get_config_cached(str(configfile), configfile.stat().st_mtime)
+
+
+@lru_cache(maxsize=8)
+def _get_config_cached(configfile: str, mtime: float) -> RoomsConfig:
+    """
+    Read and validate the config file. The modification time is only part of the cache key.
+    """
+    logger.debug("Loading config file %s modified at %s.", configfile, mtime)
     with open(configfile) as f:
-        config = yaml.safe_load(f)
-        return RoomsConfig(**config)
+        config = yaml.load(f, Loader=SafeLoader)
+        return RoomsConfig.model_validate(config)
@@ -10,12 +10,13 @@ import logging
 import os
 from datetime import datetime
 from pathlib import Path
-from typing import Dict, List
+from typing import Dict, List, Optional, Tuple
+from zoneinfo import ZoneInfo
 
 import influxdb.exceptions as inexc
 import streamlit as st
 from influxdb import InfluxDBClient
-from pytz import timezone
+from influxdb.line_protocol import quote_ident
 
 from config import RoomsConfig, get_config
 
@@ -26,7 +27,8 @@ from config import RoomsConfig, get_config
 
 config = get_config(Path("../config/config.yaml"))
 
-logging.basicConfig(level=logging.INFO)
+# logging itself is configured when importing config
+logger = logging.getLogger("water-monitoring")
 
 st.set_page_config(initial_sidebar_state='expanded',
                    layout='wide'
@@ -43,64 +45,107 @@ DB_NAME = os.getenv('DB_NAME') or 'water-monitoring'
 TIMEZONE = os.getenv('TIMEZONE') or 'Europe/Berlin'
 DEBUG = bool(os.getenv('DEBUG')) or False
 
-# connect to influxdb database
-client = InfluxDBClient(host=INFLUX_IP,
-                        port=INFLUX_PORT,
-                        username=INFLUX_USER,
-                        password=INFLUX_PASSWD
-                        )
-
-# create new database if necessary
-if not DB_NAME in [db['name'] for db in client.get_list_database()]:
-    client.create_database(DB_NAME)
-
-# select current database
-client.switch_database(DB_NAME)
-
-
-def query_last(
-    client: InfluxDBClient,
-    room_name: str,
-    meter_name: str,
-) -> float:
-
-    try:
-        iresponse = client.query(
-            f"SELECT last(\"{meter_name}\") FROM \"{room_name}\""
-        ).get_points()
-        if not iresponse:
-            raise ConnectionError(
-                "Sending data to database failed.", iresponse)
-        return list(iresponse)[0]['last']
-    except ConnectionError as e:
-        logging.error("Connection Error.\n", e)
-    except inexc.InfluxDBServerError as e:
-        logging.error("Querying latest readings from database failed due to timeout.\n", e)
-    except Exception as e:
-        logging.error("Encountered unknown error.\n", e)
+TZ = ZoneInfo(TIMEZONE)
 
 
+@st.cache_resource
+def get_client() -> InfluxDBClient:
+    """
+    Connect to the InfluxDB database.
+    The client is shared across reruns and sessions so its connection pool is reused.
+
+    Returns
+    -------
+    InfluxDBClient
+        Client connected to the selected database.
+    """
+    client = InfluxDBClient(host=INFLUX_IP,
+                            port=INFLUX_PORT,
+                            username=INFLUX_USER,
+                            password=INFLUX_PASSWD
+                            )
+
+    # create new database if necessary
+    if DB_NAME not in {db['name'] for db in client.get_list_database()}:
+        client.create_database(DB_NAME)
+
+    # select current database
+    client.switch_database(DB_NAME)
+    return client
+
+
+client = get_client()
+
+
+def meter_table(config: RoomsConfig) -> Tuple[Tuple[str, Tuple[Tuple[str, float], ...]], ...]:
+    """
+    Flatten the config into hashable tuples that can be used as cache key.
+
+    Parameters
+    ----------
+    config : RoomsConfig
+        The configured rooms and their water meters.
+
+    Returns
+    -------
+    Tuple[Tuple[str, Tuple[Tuple[str, float], ...]], ...]
+        Room names with the name and offset of each of their water meters.
+    """
+    return tuple((room.name, tuple((meter.name, meter.offset) for meter in room.meters)) for room in config.rooms)
+
+
+@st.cache_data(ttl=60, show_spinner=False)
 def get_latest_readings(
-    client: InfluxDBClient,
-    rooms: RoomsConfig,
-) -> Dict[str, Dict[str, float]]:
+    _client: InfluxDBClient,
+    rooms: Tuple[Tuple[str, Tuple[Tuple[str, float], ...]], ...],
+) -> Dict[Tuple[str, str], Optional[float]]:
     """
     Get the latest water meter readings from the database.
+    All meters are queried in a single multi-statement request to avoid one round trip per meter.
+    Results are cached for a minute and cleared whenever new readings are written.
+    Any error from the client is propagated rather than returned so that failed queries are not cached.
 
     Parameters
     ----------
-    client : InfluxDBClient
-        The InfluxDB client to write the data to.
+    _client : InfluxDBClient
+        The InfluxDB client to query the data from. Not hashed by the cache.
+    rooms : Tuple[Tuple[str, Tuple[Tuple[str, float], ...]], ...]
+        Room names with the name and offset of each of their water meters, see `meter_table`.
+
+    Returns
+    -------
+    Dict[Tuple[str, str], Optional[float]]
+        Latest reading per (room, meter) with the meter offset removed.
+        None if no reading is available.
 
     Raises
     ------
-    ConnectionError
-        Raised if the client cannot be reached.
+    InfluxDBServerError
+        Raised if the query times out or the server fails.
+    InfluxDBClientError
+        Raised if a statement of the query fails.
+    requests.exceptions.ConnectionError
+        Raised if the database cannot be reached.
     """
 
-    return {
-        room.name: {meter.name: query_last(client, room.name, meter.name)-meter.offset for meter in room.meters} for room in rooms
-    }
+    pairs = [(room, meter, offset) for room, meters in rooms for meter, offset in meters]
+    latest = {(room, meter): None for room, meter, _ in pairs}
+    if not pairs:
+        return latest
+
+    # InfluxQL only supports bind parameters for values, so the names are quoted into the query
+    query = "; ".join(f"SELECT last({quote_ident(meter)}) FROM {quote_ident(room)}" for room, meter, _ in pairs)
+    results = _client.query(query)
+
+    # a single statement is returned as a bare ResultSet instead of a list
+    if not isinstance(results, list):
+        results = [results]
+
+    for (room, meter, offset), result in zip(pairs, results):
+        point = next(result.get_points(), None)
+        if point:
+            latest[(room, meter)] = point['last'] - offset
+    return latest
 
 
 class WaterReading:
@@ -109,27 +154,26 @@ class WaterReading:
     This will be extended more functionality later.
     """
 
+    __slots__ = ('data',)
+
     def __init__(
         self,
         date: datetime.date,
         time: datetime.time,
-        room_name: str,
-        readings: dict,
+        readings: Dict[str, dict],
     ) -> None:
         """
         Format data in an InfluxDB compatible dictionary.
+        Each room becomes one point so that all rooms can be written in a single request.
+        Only entered readings are expected, rooms must contain at least one reading.
         The various groups of detailed information are separated using tags as field names can occur multiple times.
         InfluxDB stores timestamps in UTC, so it is up to the user to take care of timezones.
         """
-        isodate = datetime.combine(date, time)
-        isodate = isodate.astimezone(timezone(TIMEZONE))
-        for meter_name, value in readings.items():
-            if value == 0.0:
-                readings[meter_name] = None
+        isodate = datetime.combine(date, time).replace(tzinfo=TZ)
         self.data = [{'measurement': room_name,
                       'time': isodate,
-                      'fields': readings
-                      }]
+                      'fields': room_readings
+                      } for room_name, room_readings in readings.items()]
 
     def display(self) -> None:
         """
@@ -140,7 +184,7 @@ class WaterReading:
             st.write('Saved values:')
             st.write(self.data)
 
-    def write_to_database(self, client: InfluxDBClient) -> None:
+    def write_to_database(self, client: InfluxDBClient) -> bool:
         """
         Write the data to the database.
 
@@ -149,25 +193,32 @@ class WaterReading:
         client : InfluxDBClient
             The InfluxDB client to write the data to.
 
+        Returns
+        -------
+        bool
+            True if the data was written successfully.
+
         Raises
         ------
         ConnectionError
             Raised if the client cannot be reached.
         """
         try:
-            logging.debug(f"Writing points: {self.data}")
-            iresponse = client.write_points(self.data)
-            logging.debug(f"InfuxDB response: {iresponse}")
+            logger.debug("Writing points: %s", self.data)
+            iresponse = client.write_points(self.data, time_precision='s', batch_size=1000)
+            logger.debug("InfuxDB response: %s", iresponse)
             if not iresponse:
                 raise ConnectionError(
                     "Sending data to database failed.", iresponse)
-            self.display()
+            get_latest_readings.clear()
+            return True
         except ConnectionError as e:
-            logging.error("Connection Error.\n", e)
+            logger.error("Connection Error.\n%s", e)
         except inexc.InfluxDBServerError as e:
-            logging.error("Sending data to database failed due to timeout.\n", e)
+            logger.error("Sending data to database failed due to timeout.\n%s", e)
         except Exception as e:
-            logging.error("Encountered unknown error.\n", e)
+            logger.error("Encountered unknown error.\n%s", e)
+        return False
 
 
 ####################################################################################################
@@ -193,7 +244,17 @@ st.title('Water Monitoring')
 # data entry
 ####################################################################################################
 
-latest_readings = get_latest_readings(client, config.rooms)
+rooms = meter_table(config)
+try:
+    latest_readings = get_latest_readings(client, rooms)
+except inexc.InfluxDBServerError as e:
+    logger.error("Querying latest readings from database failed due to timeout.\n%s", e)
+    st.error("Querying latest readings from database failed due to timeout.")
+    st.stop()
+except Exception as e:
+    logger.error("Querying latest readings from database failed.\n%s", e)
+    st.error("Querying latest readings from database failed.")
+    st.stop()
 
 st.write('Enter water meter readings:')
 
@@ -209,31 +270,59 @@ with col2:
                          )
 st.text("")
 
-for room in config.rooms:
+st.session_state['pending'] = {}
+for room_name, meters in rooms:
 
-    cols = st.columns(len(room.meters)+1)
+    cols = st.columns(len(meters)+1)
     with cols[0]:
-        st.header(room.name)
-    
+        st.header(room_name)
+        confirm = st.checkbox(label='send unchanged',
+                              key=f'confirm_{room_name}',
+                              help='Also send readings that did not change since the last write.'
+                              )
+
     readings = {}
-    for col,meter in zip(cols[1:],room.meters):
+    for col, (meter_name, offset) in zip(cols[1:], meters):
         with col:
-            value = latest_readings[room.name][meter.name]
+            key = f'{room_name}_{meter_name}'
+            current = latest_readings[(room_name, meter_name)]
+            # no delta until a reading was written in this session
+            previous = st.session_state.get(f'prev_{key}')
             st.metric(
-                label=f"{room.name} {meter.name}",
-                value=value,
-                delta=value-latest_readings[room.name][meter.name]
+                label=f"{room_name} {meter_name}",
+                value=current,
+                delta=None if current is None or previous is None else round(current-previous, 3)
             )
             value = st.number_input(
                 label='new value:',
-                value=value,
+                value=current,
                 step=0.001,
                 format='%.3f',
-                key=f'{room.name}_{meter.name}'
+                key=key
             )
-            readings[meter.name] = value + meter.offset
+            # empty or 0.0 inputs were not entered, unchanged ones only count when confirmed
+            if value is not None and value != 0.0 and (confirm or value != current):
+                readings[meter_name] = value + offset
+    if readings:
+        st.session_state['pending'][room_name] = readings
 
     st.text("")
-    if st.button(label='Send', key=f"send_{room.name}"):
-        data = WaterReading(date, time, room.name, readings)
-        data.write_to_database(client)
+
+if st.button(label='Send all', key='send'):
+    if not st.session_state['pending']:
+        st.warning("No new readings entered.")
+    else:
+        data = WaterReading(date, time, st.session_state['pending'])
+        if data.write_to_database(client):
+            # remember the readings before this write to show the consumption since then
+            for room_name, readings in st.session_state['pending'].items():
+                for meter_name in readings:
+                    value = latest_readings[(room_name, meter_name)]
+                    if value is not None:
+                        st.session_state[f'prev_{room_name}_{meter_name}'] = value
+            # rerun to show the new readings and their delta, the confirmation is displayed afterwards
+            st.session_state['logged'] = data
+            st.rerun()
+
+if 'logged' in st.session_state:
+    st.session_state.pop('logged').display()